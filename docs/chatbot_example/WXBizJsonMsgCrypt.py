@@ -148,7 +148,9 @@ class Prpcrypt(object):
         @return: 加密得到的字符串
         """
         # 16位随机字符串添加到明文开头
-        text = text.encode()
+        # 确保text是bytes类型
+        if isinstance(text, str):
+            text = text.encode()
         text = self.get_random_str() + struct.pack("I", socket.htonl(len(text))) + text + receiveid.encode()
 
         # 使用自定义的填充方式对明文进行补位填充
@@ -1,87 +1,157 @@
 #!/usr/bin/env python
 # coding=utf-8
 # 文档：https://developer.work.weixin.qq.com/document/path/101039
+# 依赖：pip install "fastapi>=0.100" "pydantic>=2" "uvicorn[standard]" httpx pycryptodome cryptography orjson msgspec aiofiles
 
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import Response
+from fastapi import FastAPI, Request, HTTPException, Query
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import PlainTextResponse, Response
 import uvicorn
 import os
 import logging
-import json
-import random
-import string
 import time
 import base64
 import hashlib
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from urllib.parse import urlparse, parse_qs
 from WXBizJsonMsgCrypt import WXBizJsonMsgCrypt
-from Crypto.Cipher import AES
-import requests
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+import aiofiles
+import aiofiles.os
+import httpx
+import msgspec
+import orjson
 
-app = FastAPI()
+@asynccontextmanager
+async def _lifespan(app):
+    yield
+    await _HTTP.aclose()
+
+app = FastAPI(lifespan=_lifespan)
+# 图片回复是几 MB 的 base64 密文，压缩能收回 base64 膨胀的部分；文本回复小于阈值不压缩
+app.add_middleware(GZipMiddleware, minimum_size=4096)
+
+# 不需要回复内容的消息统一返回 success，响应对象不可变，所有请求共用一个
+_SUCCESS = PlainTextResponse("success")
 
 # 常量定义
 CACHE_DIR = "/tmp/llm_demo_cache"
 MAX_STEPS = 10
+TASK_TTL = 3600  # 任务状态保留时间(秒)
+# 单进程时任务状态保存在内存中，多进程时落盘到 CACHE_DIR 供各 worker 共享
+WORKERS = int(os.getenv('WORKERS', '1'))
 
-# 配置日志
+# 配置日志，生产环境可设置 LOG_LEVEL=WARNING 关掉每个回调的 INFO 日志和 uvicorn 访问日志
+# 大段内容(消息明文、密文)只在 DEBUG 级别以 %s 惰性格式化输出，未开启时不会拼接字符串
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+
+def _check_openssl():
+    """记录 cryptography 链接的 OpenSSL 版本，1.1 之前或 LibreSSL 没有 AES-NI 的 CBC 并行解密"""
+    backend = default_backend()
+    version = backend.openssl_version_text()
+    logger.info("图片解密使用 %s", version)
+    if 'LibreSSL' in version or backend.openssl_version_number() < 0x10100000:
+        logger.warning("当前 OpenSSL 构建不支持 AES-NI 的 CBC 并行解密，大图解密会变慢: %s", version)
+
+_check_openssl()
+
+# 回调配置只在启动时读取一次
+TOKEN = os.getenv('Token', '')
+ENCODING_AES_KEY = os.getenv('EncodingAESKey', '')
+
+def _decode_aes_key(key_base64):
+    """Base64解码AES密钥 (自动处理填充)，格式错误时返回空串，由使用方报错"""
+    try:
+        return base64.b64decode(key_base64 + "=" * (-len(key_base64) % 4))
+    except ValueError:
+        return b''
+
+# 图片解密的密钥与回调加解密相同，初始向量为密钥前16字节
+_AES_KEY = _decode_aes_key(ENCODING_AES_KEY)
+_AES_IV = _AES_KEY[:16]
+
+# 下载图片共用一个连接池，复用 TCP/TLS 连接
+# 图片消息间隔通常较长，空闲连接保留 60 秒 (httpx 默认只有 5 秒)
+_HTTP = httpx.AsyncClient(timeout=15, follow_redirects=True,
+                          limits=httpx.Limits(keepalive_expiry=60))
+
+@lru_cache(maxsize=32)
+def _get_crypt(receiveid):
+    """按 receiveid 缓存加解密实例，避免每个请求重复解析密钥"""
+    return WXBizJsonMsgCrypt(TOKEN, ENCODING_AES_KEY, receiveid)
     
 def _generate_random_string(length):
-    letters = string.ascii_letters + string.digits
-    return ''.join(random.choice(letters) for _ in range(length))
+    # 10 字节随机数编码成 16 个 base32 字符(大写字母和数字)，length 最大为 16
+    return base64.b32encode(os.urandom(10))[:length].decode('ascii')
 
-def _process_encrypted_image(image_url, aes_key_base64):
+async def _process_encrypted_image(image_url):
     """
-    下载并解密加密图片
+    下载并解密加密图片，密钥使用启动时解码的 _AES_KEY
     
     参数:
         image_url: 加密图片的URL
-        aes_key_base64: Base64编码的AES密钥(与回调加解密相同)
         
     返回:
-        tuple: (status: bool, data: bytes/str) 
-               status为True时data是解密后的图片数据，
+        tuple: (status: bool, data: tuple/str) 
+               status为True时data是 (解密后的图片数据 memoryview, 图片MD5)，
                status为False时data是错误信息
     """
     try:
-        # 1. 下载加密图片
-        logger.info("开始下载加密图片: %s", image_url)
-        response = requests.get(image_url, timeout=15)
-        response.raise_for_status()
-        encrypted_data = response.content
-        logger.info("图片下载成功，大小: %d 字节", len(encrypted_data))
-        
-        # 2. 准备AES密钥和IV
-        if not aes_key_base64:
+        # 1. 检查AES密钥
+        if not ENCODING_AES_KEY:
             raise ValueError("AES密钥不能为空")
-            
-        # Base64解码密钥 (自动处理填充)
-        aes_key = base64.b64decode(aes_key_base64 + "=" * (-len(aes_key_base64) % 4))
-        if len(aes_key) != 32:
+        if len(_AES_KEY) != 32:
             raise ValueError("无效的AES密钥长度: 应为32字节")
-            
-        iv = aes_key[:16]  # 初始向量为密钥前16字节
         
-        # 3. 解密图片数据
-        cipher = AES.new(aes_key, AES.MODE_CBC, iv)
-        decrypted_data = cipher.decrypt(encrypted_data)
+        # 2. 流式下载，边下载边解密边计算MD5 (cryptography 走 OpenSSL EVP，可利用 AES-NI)
+        #    每个网络分片有几十KB，OpenSSL 仍可在分片内多块并行解密
+        logger.info("开始下载加密图片: %s", image_url)
+        decryptor = Cipher(algorithms.AES(_AES_KEY), modes.CBC(_AES_IV)).decryptor()
+        md5 = hashlib.md5()
+        received = 0
+        size = 0    # 已解密的字节数
+        hashed = 0  # 已计入MD5的字节数
+        async with _HTTP.stream('GET', image_url) as response:
+            response.raise_for_status()
+            # 明文直接写入预分配的缓冲区，update_into 要求输出缓冲区比输入多留 15 字节
+            buf = bytearray(int(response.headers.get('content-length', 0)) + 15)
+            async for chunk in response.aiter_bytes():
+                received += len(chunk)
+                need = size + len(chunk) + 15
+                if need > len(buf):
+                    buf.extend(bytes(max(need - len(buf), len(buf))))
+                with memoryview(buf) as view:
+                    size += decryptor.update_into(chunk, view[size:])
+                    # 末尾32字节可能是填充，等确定填充长度后再计入MD5
+                    if size - 32 > hashed:
+                        md5.update(view[hashed:size - 32])
+                        hashed = size - 32
+        decryptor.finalize()
+        logger.info("图片下载成功，大小: %d 字节", received)
         
-        # 4. 去除PKCS#7填充 (Python 3兼容写法)
+        # 3. 校验并去除PKCS#7填充，切片 memoryview 不复制数据
+        decrypted_data = memoryview(buf)[:size]
         pad_len = decrypted_data[-1]  # 直接获取最后一个字节的整数值
-        if pad_len > 32:  # AES-256块大小为32字节
-            raise ValueError("无效的填充长度 (大于32字节)")
+        # AES 分组固定为16字节，但企业微信按32字节的倍数补位，合法范围是 1..32
+        if pad_len < 1 or pad_len > 32:
+            raise ValueError("无效的填充长度: %d" % pad_len)
+        # 末尾 pad_len 个字节都必须等于 pad_len，整段比较而不是逐字节循环
+        if decrypted_data[-pad_len:] != bytes((pad_len,)) * pad_len:
+            raise ValueError("无效的填充内容")
             
         decrypted_data = decrypted_data[:-pad_len]
+        md5.update(decrypted_data[hashed:])
         logger.info("图片解密成功，解密后大小: %d 字节", len(decrypted_data))
         
-        return True, decrypted_data
+        return True, (decrypted_data, md5.hexdigest())
         
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         error_msg = f"图片下载失败 : {str(e)}"
         logger.error(error_msg)
         return False, error_msg
@@ -105,42 +175,34 @@ def MakeTextStream(stream_id, content, finish):
                     "content" : content
                 }
             }
-    return json.dumps(plain, ensure_ascii=False)
+    return orjson.dumps(plain).decode()
 
-def MakeImageStream(stream_id, image_data, finish):
-    image_md5 = hashlib.md5(image_data).hexdigest()
-    image_base64 = base64.b64encode(image_data).decode('utf-8')
+def MakeImageStream(stream_id, image_data, finish, image_md5=None):
+    # 两次遍历共用同一个 memoryview，不额外复制图片数据；先算 MD5 趁数据还在缓存里
+    # 下载时已经算好 MD5 的调用方通过 image_md5 传入，省掉一遍遍历
+    view = memoryview(image_data)
+    if image_md5 is None:
+        image_md5 = hashlib.md5(view).hexdigest()
+    image_base64 = base64.b64encode(view)
 
-    plain = {
-                "msgtype": "stream",
-                "stream": {
-                    "id": stream_id,
-                    "finish": finish, 
-                    "msg_item": [
-                        {
-                            "msgtype": "image",
-                            "image": {
-                                "base64": image_base64,
-                                "md5": image_md5 
-                            }
-                        }
-                    ]
-                }
-            }
-    return json.dumps(plain)
+    # base64 和 md5 都是 ASCII，直接拼出 JSON 字节串，几 MB 的 base64 不再经过 str 和 json 序列化
+    return b''.join((
+        b'{"msgtype":"stream","stream":{"id":', orjson.dumps(stream_id),
+        b',"finish":', orjson.dumps(finish),
+        b',"msg_item":[{"msgtype":"image","image":{"base64":"', image_base64,
+        b'","md5":"', image_md5.encode('ascii'), b'"}}]}}'
+    ))
 
-def EncryptMessage(receiveid, nonce, timestamp, stream):
-    logger.info("开始加密消息，receiveid=%s, nonce=%s, timestamp=%s", receiveid, nonce, timestamp)
+def EncryptMessage(receiveid, nonce, timestamp, stream, stream_id=None, finish=None):
+    logger.debug("开始加密消息，receiveid=%s, nonce=%s, timestamp=%s", receiveid, nonce, timestamp)
     logger.debug("发送流消息: %s", stream)
 
-    wxcpt = WXBizJsonMsgCrypt(os.getenv('Token', ''), os.getenv('EncodingAESKey', ''), receiveid)
+    wxcpt = _get_crypt(receiveid)
     ret, resp = wxcpt.EncryptMsg(stream, nonce, timestamp)
     if ret != 0:
         logger.error("加密失败，错误码: %d", ret)
         return
 
-    stream_id = json.loads(stream)['stream']['id']
-    finish = json.loads(stream)['stream']['finish']
     logger.info("回调处理完成, 返回加密的流消息, stream_id=%s, finish=%s", stream_id, finish)
     logger.debug("加密后的消息: %s", resp)
 
@@ -149,67 +211,94 @@ def EncryptMessage(receiveid, nonce, timestamp, stream):
 
 # TODO 这里模拟一个大模型的行为
 class LLMDemo():
-    def __init__(self):
-        self.cache_dir = CACHE_DIR
-        if not os.path.exists(self.cache_dir):
-            os.makedirs(self.cache_dir)
+    def __init__(self, cache_dir=None):
+        # stream_id -> 任务状态，按创建时间先后插入
+        self.tasks = {}
+        # cache_dir 不为空时任务状态以 msgpack 格式落盘，读写走 aiofiles 不阻塞事件循环
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.encoder = msgspec.msgpack.Encoder()
+            self.decoder = msgspec.msgpack.Decoder()
+
+    async def _load(self, stream_id):
+        if not self.cache_dir:
+            return self.tasks.get(stream_id)
+        cache_file = os.path.join(self.cache_dir, "%s.mp" % stream_id)
+        try:
+            async with aiofiles.open(cache_file, 'rb') as f:
+                return self.decoder.decode(await f.read())
+        except FileNotFoundError:
+            return None
+
+    async def _save(self, stream_id, task_data):
+        if not self.cache_dir:
+            self.tasks[stream_id] = task_data
+            return
+        # 先写临时文件再 rename，其他 worker 不会读到写了一半的文件
+        cache_file = os.path.join(self.cache_dir, "%s.mp" % stream_id)
+        tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+        async with aiofiles.open(tmp_file, 'wb') as f:
+            await f.write(self.encoder.encode(task_data))
+        await aiofiles.os.replace(tmp_file, cache_file)
 
-    def invoke(self, question):
+    def _evict_expired(self):
+        deadline = time.time() - TASK_TTL
+        while self.tasks:
+            stream_id = next(iter(self.tasks))
+            if self.tasks[stream_id]['created_time'] > deadline:
+                break
+            del self.tasks[stream_id]
+
+    async def invoke(self, question):
+        self._evict_expired()
         stream_id = _generate_random_string(10) # 生成一个随机字符串作为任务ID
-        # 创建任务缓存文件
-        cache_file = os.path.join(self.cache_dir, "%s.json" % stream_id)
-        with open(cache_file, 'w', encoding='utf-8') as f:
-            json.dump({
-                'question': question,
-                'created_time': time.time(),
-                'current_step': 0,
-                'max_steps': MAX_STEPS
-            }, f)
+        await self._save(stream_id, {
+            'question': question,
+            'created_time': time.time(),
+            'current_step': 0,
+            'max_steps': MAX_STEPS
+        })
         return stream_id
 
-    def get_answer(self, stream_id):
-        cache_file = os.path.join(self.cache_dir, "%s.json" % stream_id)
-        if not os.path.exists(cache_file):
+    async def get_answer(self, stream_id):
+        task_data = await self._load(stream_id)
+        if task_data is None:
             return u"任务不存在或已过期"
-            
-        with open(cache_file, 'r', encoding='utf-8') as f:
-            task_data = json.load(f)
-        
-        # 更新缓存
-        current_step = task_data['current_step'] + 1
-        task_data['current_step'] = current_step
-        with open(cache_file, 'w', encoding='utf-8') as f:
-            json.dump(task_data, f)
-            
+
+        # 更新任务状态
+        task_data['current_step'] += 1
+        current_step = task_data['current_step']
+        await self._save(stream_id, task_data)
+
         response = u'收到问题：%s\n' % task_data['question']
         for i in range(current_step):
             response += u'处理步骤 %d: 已完成\n' % (i)
 
         return response
 
-    def is_task_finish(self, stream_id):
-        cache_file = os.path.join(self.cache_dir, "%s.json" % stream_id)
-        if not os.path.exists(cache_file):
+    async def is_task_finish(self, stream_id):
+        task_data = await self._load(stream_id)
+        if task_data is None:
             return True
-            
-        with open(cache_file, 'r', encoding='utf-8') as f:
-            task_data = json.load(f)
-            
+
         return task_data['current_step'] >= task_data['max_steps']
 
+llm = LLMDemo(CACHE_DIR if WORKERS > 1 else None)
+
 
 @app.get("/ai-bot/callback/demo/{botid}")
 async def verify_url(
     request: Request,
     botid: str,
-    msg_signature: str,
-    timestamp: str,
-    nonce: str,
-    echostr: str
-):
+    msg_signature: str = Query(..., min_length=1),
+    timestamp: str = Query(..., min_length=1),
+    nonce: str = Query(..., min_length=1),
+    echostr: str = Query(..., min_length=1)
+) -> Response:
     # 企业创建的自能机器人的 VerifyUrl 请求, receiveid 是空串
     receiveid = ''
-    wxcpt = WXBizJsonMsgCrypt(os.getenv('Token', ''), os.getenv('EncodingAESKey', ''), receiveid)
+    wxcpt = _get_crypt(receiveid)
     
     ret, echostr = wxcpt.VerifyURL(
         msg_signature,
@@ -227,20 +316,18 @@ async def verify_url(
 async def handle_message(
     request: Request,
     botid: str,
-    msg_signature: str = None,
-    timestamp: str = None,
-    nonce: str = None
-):
-    query_params = dict(request.query_params)
-    if not all([msg_signature, timestamp, nonce]):
-        raise HTTPException(status_code=400, detail="缺少必要参数")
+    msg_signature: str = Query(..., min_length=1),
+    timestamp: str = Query(..., min_length=1),
+    nonce: str = Query(..., min_length=1)
+) -> Response:
+    # 必要参数由 FastAPI 校验，缺失或为空时直接返回 422
     logger.info("收到消息，botid=%s, msg_signature=%s, timestamp=%s, nonce=%s", botid, msg_signature, timestamp, nonce)
     
     post_data = await request.body()
     
     # 智能机器人的 receiveid 是空串
     receiveid = ''
-    wxcpt = WXBizJsonMsgCrypt(os.getenv('Token', ''), os.getenv('EncodingAESKey', ''), receiveid)
+    wxcpt = _get_crypt(receiveid)
     
     ret, msg = wxcpt.DecryptMsg(
         post_data,
@@ -252,63 +339,62 @@ async def handle_message(
     if ret != 0:
         raise HTTPException(status_code=400, detail="解密失败")
     
-    data = json.loads(msg)
+    data = orjson.loads(msg)
     logger.debug('Decrypted data: %s', data)
     if 'msgtype' not in data:
         logger.info("不认识的事件: %s", data)
-        return Response(content="success", media_type="text/plain")
+        return _SUCCESS
 
     msgtype = data['msgtype']
     if(msgtype == 'text'):
         content = data['text']['content']
 
         # 询问大模型产生回复
-        llm = LLMDemo()
-        stream_id = llm.invoke(content)
-        answer = llm.get_answer(stream_id)
-        finish = llm.is_task_finish(stream_id)
+        stream_id = await llm.invoke(content)
+        answer = await llm.get_answer(stream_id)
+        finish = await llm.is_task_finish(stream_id)
 
         stream = MakeTextStream(stream_id, answer, finish)
-        resp = EncryptMessage(receiveid, nonce, timestamp, stream)
+        resp = EncryptMessage(receiveid, nonce, timestamp, stream, stream_id, finish)
         return Response(content=resp, media_type="text/plain")
     elif (msgtype == 'stream'):  # case stream
         # 询问大模型最新的回复
         stream_id = data['stream']['id']
-        llm = LLMDemo()
-        answer = llm.get_answer(stream_id)
-        finish = llm.is_task_finish(stream_id)
+        answer = await llm.get_answer(stream_id)
+        finish = await llm.is_task_finish(stream_id)
 
         stream = MakeTextStream(stream_id, answer, finish)
-        resp = EncryptMessage(receiveid, nonce, timestamp, stream)
+        resp = EncryptMessage(receiveid, nonce, timestamp, stream, stream_id, finish)
         return Response(content=resp, media_type="text/plain")
     elif (msgtype == 'image'):
-        # 从环境变量获取AES密钥
-        aes_key = os.getenv('EncodingAESKey', '')  
-        
         # 调用图片处理函数
-        success, result = _process_encrypted_image(data['image']['url'], aes_key)
+        success, result = await _process_encrypted_image(data['image']['url'])
         if not success:
             logger.error("图片处理失败: %s", result)
-            return
+            raise HTTPException(status_code=500, detail=result)
 
         # 这里简单处理直接原图回复
-        decrypted_data = result
+        decrypted_data, image_md5 = result
         stream_id = _generate_random_string(10)
         finish = True
 
-        stream = MakeImageStream(stream_id, decrypted_data, finish)
-        resp = EncryptMessage(receiveid, nonce, timestamp, stream)
+        stream = MakeImageStream(stream_id, decrypted_data, finish, image_md5)
+        resp = EncryptMessage(receiveid, nonce, timestamp, stream, stream_id, finish)
         return Response(content=resp, media_type="text/plain")
     elif (msgtype == 'mixed'):
         # TODO 处理图文混排消息
         logger.warning("需要支持mixed消息类型")
+        return _SUCCESS
     elif (msgtype == 'event'):  
         # TODO 一些事件的处理
         logger.warning("需要支持event消息类型: %s", data)
-        return
+        return _SUCCESS
     else:
         logger.warning("不支持的消息类型: %s", msgtype)
-        return
+        return _SUCCESS
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=80)
+    # 多进程时 uvicorn 需要以 "模块:变量" 的形式加载应用
+    uvicorn.run("demo_server:app", host="0.0.0.0", port=80,
+                loop="uvloop", http="httptools", workers=WORKERS,
+                access_log=logger.isEnabledFor(logging.INFO))